@@ -15,19 +15,26 @@
 # limitations under the License.
 
 import argparse
-import copy
-import json
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import math
+import queue
 import sys
 import threading
 import time
 from typing import Optional
 
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 import numpy as np
+import orjson
 from pydantic import BaseModel
 from pyproj import Transformer
 import rclpy
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
 from rclpy.qos import qos_profile_system_default
 from rclpy.qos import QoSDurabilityPolicy as Durability
@@ -49,6 +56,9 @@ import yaml
 
 app = FastAPI()
 
+# Minimum time in seconds between republishes of a robot's last path request
+REPUBLISH_PERIOD = 0.25
+
 
 class Request(BaseModel):
     map_name: Optional[str] = None
@@ -66,10 +76,40 @@ class Response(BaseModel):
     msg: str
 
 
+# ------------------------------------------------------------------------------
+# Helpers
+# ------------------------------------------------------------------------------
+@lru_cache(maxsize=8)
+def _get_transformer(src_crs, dst_crs):
+    # Building a Transformer is expensive, so share one per CRS pair across
+    # all robots instead of constructing it for every State.
+    return Transformer.from_crs(src_crs, dst_crs)
+
+
+def _arrival_duration(px, py, pyaw, tx, ty, tyaw, inv_lin_v, inv_rot_v):
+    # Estimated time to drive to the target and turn to its heading
+    return (
+        math.hypot(px - tx, py - ty) * inv_lin_v
+        + abs(math.remainder(pyaw - tyaw, math.tau)) * inv_rot_v
+    )
+
+
 # ------------------------------------------------------------------------------
 # Fleet Manager
 # ------------------------------------------------------------------------------
 class State:
+    __slots__ = (
+        'state',
+        'destination',
+        'last_path_request',
+        'last_completed_request',
+        'perform_action_mode',
+        'gps_pos',
+        '_rev',
+        '_cached_status',
+        '_cached_status_rev',
+        '_last_republish_time',
+    )
 
     def __init__(self, state: RobotState = None, destination: Location = None):
         self.state = state
@@ -77,15 +117,33 @@ class State:
         self.last_path_request = None
         self.last_completed_request = None
         self.perform_action_mode = False
-        self.svy_transformer = Transformer.from_crs('EPSG:4326', 'EPSG:3414')
-        self.gps_pos = [0, 0]
-
-    def gps_to_xy(self, gps_json: dict):
-        svy21_xy = self.svy_transformer.transform(
-            gps_json['lat'], gps_json['lon']
-        )
-        self.gps_pos[0] = svy21_xy[1]
-        self.gps_pos[1] = svy21_xy[0]
+        self.gps_pos = None
+        # Revision of the state, used to invalidate the cached status
+        self._rev = 0
+        self._cached_status = None
+        self._cached_status_rev = -1
+        # Monotonic time of the last republish of last_path_request
+        self._last_republish_time = 0.0
+
+    def mark_changed(self):
+        self._rev += 1
+
+    def cached_status(self, build_status, *args):
+        # Status is polled far more often than the robot state changes, so
+        # only rebuild it when the state revision has moved on
+        rev = self._rev
+        if self._cached_status_rev != rev:
+            self._cached_status = build_status(self, *args)
+            self._cached_status_rev = rev
+        return self._cached_status
+
+    def should_republish(self, now):
+        # Limit resends of last_path_request to one every REPUBLISH_PERIOD
+        # instead of one per state update
+        if now - self._last_republish_time < REPUBLISH_PERIOD:
+            return False
+        self._last_republish_time = now
+        return True
 
     def is_expected_task_id(self, task_id):
         if self.last_path_request is not None:
@@ -117,8 +175,16 @@ class FleetManager(Node):
         self.robots = {}  # Map robot name to state
         self.action_paths = {}  # Map activities to paths
 
-        for robot_name, _ in self.config['rmf_fleet']['robots'].items():
-            self.robots[robot_name] = State()
+        robot_names = list(self.config['rmf_fleet']['robots'])
+        # GPS positions of all robots, one [x, y] row per robot
+        self.gps_positions = np.zeros((len(robot_names), 2))
+        self.robot_index = {}  # Map robot name to its gps_positions row
+        for i, robot_name in enumerate(robot_names):
+            self.robot_index[robot_name] = i
+            state = State()
+            # Row view into gps_positions, so batched writes update it
+            state.gps_pos = self.gps_positions[i]
+            self.robots[robot_name] = state
         assert len(self.robots) > 0
 
         profile = traits.Profile(
@@ -141,21 +207,60 @@ class FleetManager(Node):
         self.vehicle_traits.differential.reversible = self.config['rmf_fleet'][
             'reversible'
         ]
+        # Inverse nominal velocities, cached to avoid going through the
+        # vehicle traits bindings for every arrival estimate
+        self._inv_lin_v = 1.0 / self.vehicle_traits.linear.nominal_velocity
+        self._inv_rot_v = (
+            1.0 / self.vehicle_traits.rotational.nominal_velocity
+        )
 
         fleet_manager_config = self.config['fleet_manager']
         self.action_paths = fleet_manager_config.get('action_paths', {})
+        # Map activities to the Location messages of their paths. These are
+        # shared by every request for the activity and must not be modified.
+        self.action_locations = {}
+        for activity, labels in self.action_paths.items():
+            self.action_locations[activity] = {}
+            for label, activity_path in labels.items():
+                map_name = activity_path['map_name']
+                self.action_locations[activity][label] = [
+                    Location(
+                        x=float(wp[0]),
+                        y=float(wp[1]),
+                        yaw=float(wp[2]),
+                        level_name=map_name,
+                    )
+                    for wp in activity_path['path']
+                ]
+        self.svy_transformer = _get_transformer('EPSG:4326', 'EPSG:3414')
+        # GPS updates are queued as (robot_name, lat, lon) and transformed in
+        # batches by gps_to_xy
+        self.gps_queue = deque()
         self.sio = socketio.Client()
 
         @self.sio.on('/gps')
         def message(data):
             try:
-                robot = json.loads(data)
+                robot = orjson.loads(data)
                 robot_name = robot['robot_id']
-                self.robots[robot_name].gps_to_xy(robot)
-            except KeyError as e:
+                lat = float(robot['lat'])
+                lon = float(robot['lon'])
+            except (KeyError, TypeError, ValueError) as e:
                 self.get_logger().info(f'Malformed GPS Message!: {e}')
+                return
+            if robot_name not in self.robots:
+                self.get_logger().info(
+                    f'GPS Message for unknown robot [{robot_name}]'
+                )
+                return
+            self.gps_queue.append((robot_name, lat, lon))
 
         if self.gps:
+            self.create_timer(
+                0.02,
+                self.gps_to_xy,
+                callback_group=MutuallyExclusiveCallbackGroup(),
+            )
             while True:
                 try:
                     self.sio.connect('http://0.0.0.0:8080')
@@ -167,8 +272,18 @@ class FleetManager(Node):
                     )
                     time.sleep(1)
 
+        # RobotState messages are processed on a worker thread so the rclpy
+        # executor is not held up by them
+        self.robot_state_queue = queue.Queue(maxsize=100)
+        threading.Thread(
+            target=self.robot_state_worker, daemon=True
+        ).start()
         self.create_subscription(
-            RobotState, 'robot_state', self.robot_state_cb, 100
+            RobotState,
+            'robot_state',
+            self.robot_state_cb,
+            100,
+            callback_group=MutuallyExclusiveCallbackGroup(),
         )
 
         transient_qos = QoSProfile(
@@ -183,6 +298,7 @@ class FleetManager(Node):
             'dock_summary',
             self.dock_summary_cb,
             qos_profile=transient_qos,
+            callback_group=MutuallyExclusiveCallbackGroup(),
         )
 
         publisher_qos = QoSProfile(
@@ -208,25 +324,30 @@ class FleetManager(Node):
             qos_profile=qos_profile_system_default,
         )
 
-        @app.get('/open-rmf/rmf_demos_fm/status/', response_model=Response)
+        # Publishing crosses into rclpy and may block, so the async endpoints
+        # hand their publishes to this single worker to keep them ordered
+        # without stalling the event loop.
+        self.publish_executor = ThreadPoolExecutor(max_workers=1)
+
+        @app.get(
+            '/open-rmf/rmf_demos_fm/status/', response_class=ORJSONResponse
+        )
         async def status(robot_name: Optional[str] = None):
             response = {'data': {}, 'success': False, 'msg': ''}
             if robot_name is None:
-                response['data']['all_robots'] = []
-                for robot_name in self.robots:
-                    state = self.robots.get(robot_name)
-                    if state is None or state.state is None:
-                        return response
-                    response['data']['all_robots'].append(
-                        self.get_robot_state(state, robot_name)
-                    )
+                all_robots = response['data']['all_robots'] = []
+                get_robot_state = self.get_robot_state
+                for robot_name, state in self.robots.items():
+                    if state.state is None:
+                        return ORJSONResponse(content=response)
+                    all_robots.append(get_robot_state(state, robot_name))
             else:
                 state = self.robots.get(robot_name)
                 if state is None or state.state is None:
-                    return response
+                    return ORJSONResponse(content=response)
                 response['data'] = self.get_robot_state(state, robot_name)
             response['success'] = True
-            return response
+            return ORJSONResponse(content=response)
 
         @app.post('/open-rmf/rmf_demos_fm/navigate/', response_model=Response)
         async def navigate(robot_name: str, cmd_id: int, dest: Request):
@@ -249,20 +370,13 @@ class FleetManager(Node):
 
             t = self.get_clock().now().to_msg()
 
-            path_request = PathRequest()
-            robot = self.robots[robot_name]
-            cur_x = robot.state.location.x
-            cur_y = robot.state.location.y
-            cur_yaw = robot.state.location.yaw
             cur_loc = robot.state.location
-            path_request.path.append(cur_loc)
+            cur_x, cur_y, cur_yaw = cur_loc.x, cur_loc.y, cur_loc.yaw
 
             disp = self.disp([target_x, target_y], [cur_x, cur_y])
-            duration = int(
-                disp / self.vehicle_traits.linear.nominal_velocity
-            ) + int(
-                abs(abs(cur_yaw) - abs(target_yaw))
-                / self.vehicle_traits.rotational.nominal_velocity
+            duration = int(disp * self._inv_lin_v) + int(
+                abs(math.remainder(cur_yaw - target_yaw, math.tau))
+                * self._inv_rot_v
             )
             t.sec = t.sec + duration
             target_loc = Location()
@@ -276,16 +390,16 @@ class FleetManager(Node):
                 target_loc.obey_approach_speed_limit = True
                 target_loc.approach_speed_limit = target_speed_limit
 
-            path_request.fleet_name = self.fleet_name
-            path_request.robot_name = robot_name
-            path_request.path.append(target_loc)
-            path_request.task_id = str(cmd_id)
-            self.path_pub.publish(path_request)
+            path_request = self._make_path_request(
+                robot_name, cmd_id, [cur_loc, target_loc]
+            )
+            robot.last_path_request = path_request
+            robot.destination = target_loc
+            robot.mark_changed()
+            await self._publish(self.path_pub, path_request)
 
             if self.debug:
                 print(f'Sending navigate request for {robot_name}: {cmd_id}')
-            robot.last_path_request = path_request
-            robot.destination = target_loc
 
             response['success'] = True
             return response
@@ -297,24 +411,22 @@ class FleetManager(Node):
                 return response
 
             robot = self.robots[robot_name]
-            path_request = PathRequest()
-            path_request.fleet_name = self.fleet_name
-            path_request.robot_name = robot_name
-            path_request.path = []
-            # Appending the current location twice will effectively tell the
+            # Sending the current location twice will effectively tell the
             # robot to stop
-            path_request.path.append(robot.state.location)
-            path_request.path.append(robot.state.location)
-
-            path_request.task_id = str(stop_cmd_id)
-            self.path_pub.publish(path_request)
+            path_request = self._make_path_request(
+                robot_name,
+                stop_cmd_id,
+                [robot.state.location, robot.state.location],
+            )
+            robot.last_path_request = path_request
+            robot.destination = None
+            robot.mark_changed()
+            await self._publish(self.path_pub, path_request)
 
             if self.debug:
                 print(
                     f'Sending stop request for {robot_name}: {running_cmd_id}'
                 )
-            robot.last_path_request = path_request
-            robot.destination = None
 
             response['success'] = True
             return response
@@ -353,33 +465,25 @@ class FleetManager(Node):
                 return response
             robot = self.robots[robot_name]
 
-            path_request = PathRequest()
             cur_loc = robot.state.location
-            target_loc = Location()
-            path_request.path.append(cur_loc)
-
             activity_path = self.action_paths[request.activity][request.label]
-            map_name = activity_path['map_name']
-            for wp in activity_path['path']:
-                target_loc = Location()
-                target_loc.x = wp[0]
-                target_loc.y = wp[1]
-                target_loc.yaw = wp[2]
-                target_loc.level_name = map_name
-                path_request.path.append(target_loc)
-
-            path_request.fleet_name = self.fleet_name
-            path_request.robot_name = robot_name
-            path_request.task_id = str(cmd_id)
-            self.path_pub.publish(path_request)
+            activity_locs = self.action_locations[request.activity][
+                request.label
+            ]
+            target_loc = activity_locs[-1] if activity_locs else Location()
+            path = [cur_loc, *activity_locs]
+
+            path_request = self._make_path_request(robot_name, cmd_id, path)
+            robot.last_path_request = path_request
+            robot.destination = target_loc
+            robot.mark_changed()
+            await self._publish(self.path_pub, path_request)
 
             if self.debug:
                 print(
                     f'Sending [{request.activity}] at [{request.label}] '
                     f'request for {robot_name}: {cmd_id}'
                 )
-            robot.last_path_request = path_request
-            robot.destination = target_loc
 
             response['success'] = True
             response['data'] = {}
@@ -418,10 +522,33 @@ class FleetManager(Node):
                 msg = self._make_mode_request(robot_name, cmd_id,
                                               RobotMode.MODE_PERFORMING_ACTION,
                                               'detach_cart')
-            self.mode_pub.publish(msg)
+            await self._publish(self.mode_pub, msg)
             response['success'] = True
             return response
 
+    async def _publish(self, publisher, msg):
+        await asyncio.wrap_future(
+            self.publish_executor.submit(publisher.publish, msg)
+        )
+
+    def _publish_nowait(self, publisher, msg):
+        # Nothing awaits this publish, so log its failure instead
+        future = self.publish_executor.submit(publisher.publish, msg)
+        future.add_done_callback(self._log_publish_error)
+
+    def _log_publish_error(self, future):
+        error = future.exception()
+        if error is not None:
+            self.get_logger().error(f'Failed to publish: {error}')
+
+    def _make_path_request(self, robot_name, cmd_id, path):
+        return PathRequest(
+            fleet_name=self.fleet_name,
+            robot_name=robot_name,
+            path=path,
+            task_id=str(cmd_id),
+        )
+
     def _make_mode_request(self, robot_name, cmd_id, mode, action=''):
         mode_msg = ModeRequest()
         mode_msg.fleet_name = self.fleet_name
@@ -432,6 +559,28 @@ class FleetManager(Node):
         return mode_msg
 
     def robot_state_cb(self, msg):
+        while True:
+            try:
+                self.robot_state_queue.put_nowait(msg)
+                return
+            except queue.Full:
+                # Evict the oldest state so the worker always gets to apply
+                # the freshest one
+                try:
+                    dropped = self.robot_state_queue.get_nowait()
+                except queue.Empty:
+                    continue
+                self.get_logger().warning(
+                    f'Dropping robot state of {dropped.name}, processing is '
+                    'behind',
+                    throttle_duration_sec=5.0,
+                )
+
+    def robot_state_worker(self):
+        while True:
+            self.process_robot_state(self.robot_state_queue.get())
+
+    def process_robot_state(self, msg):
         if msg.name in self.robots:
             robot = self.robots[msg.name]
             if (
@@ -439,7 +588,10 @@ class FleetManager(Node):
                 and not robot.perform_action_mode
             ):
                 # This message is out of date, so disregard it.
-                if robot.last_path_request is not None:
+                if (
+                    robot.last_path_request is not None
+                    and robot.should_republish(time.monotonic())
+                ):
                     # Resend the latest task request for this robot, in case
                     # the message was dropped.
                     if self.debug:
@@ -472,6 +624,28 @@ class FleetManager(Node):
                         )
                 robot.last_completed_request = completed_request
 
+            robot.mark_changed()
+
+    def gps_to_xy(self):
+        if not self.gps_queue:
+            return
+        # Only the latest fix of each robot is kept. popleft is atomic, so
+        # the socketio thread can keep appending while the queue is drained.
+        latest = {}
+        while self.gps_queue:
+            robot_name, lat, lon = self.gps_queue.popleft()
+            latest[robot_name] = (lat, lon)
+        names = list(latest)
+        lats, lons = zip(*latest.values())
+        svy21_y, svy21_x = self.svy_transformer.transform(
+            np.asarray(lats), np.asarray(lons)
+        )
+        rows = [self.robot_index[robot_name] for robot_name in names]
+        self.gps_positions[rows, 0] = svy21_x
+        self.gps_positions[rows, 1] = svy21_y
+        for robot_name in names:
+            self.robots[robot_name].mark_changed()
+
     def dock_summary_cb(self, msg):
         for fleet in msg.docks:
             if fleet.fleet_name == self.fleet_name:
@@ -479,16 +653,36 @@ class FleetManager(Node):
                     self.docks[dock.start] = dock.path
 
     def get_robot_state(self, robot: State, robot_name):
+        data = robot.cached_status(self._make_robot_status, robot_name)
+
+        if (robot.state.mode.mode == RobotMode.MODE_ACTION_COMPLETED):
+            self.get_logger().info(
+                f'Robot [{robot_name} completed performing its action')
+            completed_cmd_id = 0
+            msg = self._make_mode_request(robot_name, completed_cmd_id,
+                                          RobotMode.MODE_IDLE)
+            # Publish on the publish executor so the status endpoint does not
+            # block the event loop, and to stay ordered with other publishes.
+            # Mark action execution as finished
+            self._publish_nowait(self.action_completed_pub, msg)
+            # Request for robot idle
+            self._publish_nowait(self.mode_pub, msg)
+
+        return data
+
+    def _make_robot_status(self, robot: State, robot_name):
         data = {}
+        state = robot.state
+        location = state.location
         if self.gps:
-            position = copy.deepcopy(robot.gps_pos)
+            position = robot.gps_pos.tolist()
         else:
-            position = [robot.state.location.x, robot.state.location.y]
-        angle = robot.state.location.yaw
+            position = [location.x, location.y]
+        angle = location.yaw
         data['robot_name'] = robot_name
-        data['map_name'] = robot.state.location.level_name
+        data['map_name'] = location.level_name
         data['position'] = {'x': position[0], 'y': position[1], 'yaw': angle}
-        data['battery'] = robot.state.battery_percent
+        data['battery'] = state.battery_percent
         if (
             robot.destination is not None
             and robot.last_path_request is not None
@@ -498,18 +692,15 @@ class FleetManager(Node):
             if self.gps:
                 position[0] -= self.offset[0]
                 position[1] -= self.offset[1]
-            # calculate arrival estimate
-            dist_to_target = self.disp(
-                position, [destination.x, destination.y]
-            )
-            ori_delta = abs(abs(angle) - abs(destination.yaw))
-            if ori_delta > np.pi:
-                ori_delta = ori_delta - (2 * np.pi)
-            if ori_delta < -np.pi:
-                ori_delta = (2 * np.pi) + ori_delta
-            duration = (
-                dist_to_target / self.vehicle_traits.linear.nominal_velocity
-                + ori_delta / self.vehicle_traits.rotational.nominal_velocity
+            duration = _arrival_duration(
+                position[0],
+                position[1],
+                angle,
+                destination.x,
+                destination.y,
+                destination.yaw,
+                self._inv_lin_v,
+                self._inv_rot_v,
             )
             cmd_id = int(robot.last_path_request.task_id)
             data['destination_arrival'] = {
@@ -520,9 +711,10 @@ class FleetManager(Node):
             data['destination_arrival'] = None
 
         data['last_completed_request'] = robot.last_completed_request
+        mode = state.mode.mode
         if (
-            robot.state.mode.mode == RobotMode.MODE_WAITING
-            or robot.state.mode.mode == RobotMode.MODE_ADAPTER_ERROR
+            mode == RobotMode.MODE_WAITING
+            or mode == RobotMode.MODE_ADAPTER_ERROR
         ):
             # The name of MODE_WAITING is not very intuitive, but the slotcar
             # plugin uses it to indicate when another robot is blocking its
@@ -535,21 +727,10 @@ class FleetManager(Node):
             data['replan'] = True
         else:
             data['replan'] = False
-        if (robot.state.mode.mode == RobotMode.MODE_ACTION_COMPLETED):
-            self.get_logger().info(
-                f'Robot [{robot_name} completed performing its action')
-            completed_cmd_id = 0
-            msg = self._make_mode_request(robot_name, completed_cmd_id,
-                                          RobotMode.MODE_IDLE)
-            # Mark action execution as finished
-            self.action_completed_pub.publish(msg)
-            # # Request for robot idle
-            self.mode_pub.publish(msg)
-
         return data
 
     def disp(self, A, B):
-        return math.sqrt((A[0] - B[0]) ** 2 + (A[1] - B[1]) ** 2)
+        return math.hypot(A[0] - B[0], A[1] - B[1])
 
 
 # ------------------------------------------------------------------------------
@@ -580,13 +761,17 @@ def main(argv=sys.argv):
 
     fleet_manager = FleetManager(config)
 
-    spin_thread = threading.Thread(target=rclpy.spin, args=(fleet_manager,))
+    executor = MultiThreadedExecutor(num_threads=2)
+    executor.add_node(fleet_manager)
+    spin_thread = threading.Thread(target=executor.spin)
     spin_thread.start()
 
     uvicorn.run(
         app,
         host=config['fleet_manager']['ip'],
         port=config['fleet_manager']['port'],
+        loop='uvloop',
+        http='httptools',
         log_level='warning',
     )
 
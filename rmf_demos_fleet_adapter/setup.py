@@ -22,7 +22,14 @@ setup(
             glob('launch/*.launch.xml'),
         ),
     ],
-    install_requires=['setuptools', 'fastapi>=0.79.0', 'uvicorn>=0.18.2'],
+    install_requires=[
+        'setuptools',
+        'fastapi>=0.79.0',
+        'httptools',
+        'orjson',
+        'uvicorn>=0.18.2',
+        'uvloop',
+    ],
     zip_safe=True,
     maintainer='Xi Yu Oh',
     maintainer_email='xiyu@openrobotics.org',